@@ -1,5 +1,9 @@
+import asyncio
+import importlib.util
+import io
 import logging
 import os
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 import psycopg
 from psycopg.rows import dict_row
@@ -17,6 +21,7 @@ from aiogram.types import (
     InlineKeyboardButton,
     ReplyKeyboardMarkup,
     KeyboardButton,
+    BufferedInputFile,
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.client.default import DefaultBotProperties
@@ -34,6 +39,10 @@ if not TOKEN:
 if not DATABASE_URL:
     logging.warning("DATABASE_URL не найден → статистика и сохранение работать не будут")
 
+CHARTS_ENABLED = importlib.util.find_spec("matplotlib") is not None
+if not CHARTS_ENABLED:
+    logging.warning("matplotlib не установлен → диаграммы в статистике отключены")
+
 bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
@@ -83,6 +92,14 @@ def init_db():
                     UNIQUE(user_id, type, name)
                 )
             """)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS balances (
+                    user_id BIGINT PRIMARY KEY,
+                    income DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    expense DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    debt DOUBLE PRECISION NOT NULL DEFAULT 0
+                )
+            """)
         conn.commit()
         logging.info("Database tables initialized")
     except Exception as e:
@@ -91,6 +108,92 @@ def init_db():
         conn.close()
 
 
+# --------------------- Сводные балансы ---------------------
+# balances хранит текущие суммы доходов, расходов и долгов пользователя.
+# Строка меняется в той же транзакции, что и transactions/debts,
+# поэтому show_balance читает одну строку вместо суммирования всей истории.
+BALANCE_EPSILON = 0.01
+
+
+def update_balance(cur, user_id: int, income: float = 0, expense: float = 0, debt: float = 0):
+    cur.execute("""
+        INSERT INTO balances (user_id, income, expense, debt) VALUES (%s, %s, %s, %s)
+        ON CONFLICT (user_id) DO UPDATE SET
+            income = balances.income + EXCLUDED.income,
+            expense = balances.expense + EXCLUDED.expense,
+            debt = balances.debt + EXCLUDED.debt
+    """, (user_id, income, expense, debt))
+
+
+def check_balances(repair: bool = True):
+    """Сверяет balances с историей transactions/debts и при repair=True исправляет расхождения.
+
+    Возвращает список user_id, у которых баланс разошёлся с историей.
+    """
+    conn = get_db_connection()
+    if not conn:
+        return []
+    try:
+        with conn.cursor() as cur:
+            if repair:
+                # Блокируем запись до конца исправления, иначе добавленная между SELECT и UPSERT
+                # транзакция потеряется. Порядок таблиц тот же, что в обработчиках.
+                cur.execute("LOCK TABLE transactions, debts, balances IN SHARE ROW EXCLUSIVE MODE")
+            cur.execute("""
+                SELECT u.user_id,
+                       COALESCE(t.income, 0) AS income,
+                       COALESCE(t.expense, 0) AS expense,
+                       COALESCE(d.debt, 0) AS debt,
+                       b.income AS stored_income,
+                       b.expense AS stored_expense,
+                       b.debt AS stored_debt
+                FROM (
+                    SELECT user_id FROM transactions
+                    UNION SELECT user_id FROM debts
+                    UNION SELECT user_id FROM balances
+                ) u
+                LEFT JOIN (
+                    SELECT user_id,
+                           SUM(CASE WHEN type='income' THEN amount::double precision ELSE 0 END) AS income,
+                           SUM(CASE WHEN type='expense' THEN amount::double precision ELSE 0 END) AS expense
+                    FROM transactions
+                    GROUP BY user_id
+                ) t USING (user_id)
+                LEFT JOIN (
+                    SELECT user_id, SUM(amount::double precision) AS debt
+                    FROM debts
+                    GROUP BY user_id
+                ) d USING (user_id)
+                LEFT JOIN balances b USING (user_id)
+            """)
+            drifted = [
+                row for row in cur.fetchall()
+                if row["stored_income"] is None
+                or abs(row["income"] - row["stored_income"]) > BALANCE_EPSILON
+                or abs(row["expense"] - row["stored_expense"]) > BALANCE_EPSILON
+                or abs(row["debt"] - row["stored_debt"]) > BALANCE_EPSILON
+            ]
+            if repair:
+                for row in drifted:
+                    cur.execute("""
+                        INSERT INTO balances (user_id, income, expense, debt) VALUES (%s, %s, %s, %s)
+                        ON CONFLICT (user_id) DO UPDATE SET
+                            income = EXCLUDED.income,
+                            expense = EXCLUDED.expense,
+                            debt = EXCLUDED.debt
+                    """, (row["user_id"], row["income"], row["expense"], row["debt"]))
+        conn.commit()
+        if drifted:
+            action = "исправлены" if repair else "обнаружены"
+            logging.warning(f"Balance drift {action} для {len(drifted)} пользователей")
+        return [row["user_id"] for row in drifted]
+    except Exception as e:
+        logging.error(f"Balance check error: {e}")
+        return []
+    finally:
+        conn.close()
+
+
 # --------------------- Категории ---------------------
 DEFAULT_INCOME = [
     "Зарплата 💳", "Аванс 💰", "Премия 🎉", "Фриланс 💻",
@@ -212,10 +315,17 @@ async def add_transaction(message: Message, state: FSMContext):
         try:
             with conn.cursor() as cur:
                 cur.execute(
-                    "INSERT INTO transactions (user_id, type, category, amount, date) VALUES (%s, %s, %s, %s, %s)",
+                    "INSERT INTO transactions (user_id, type, category, amount, date) VALUES (%s, %s, %s, %s, %s) RETURNING amount",
                     (message.from_user.id, typ, cat, amount, datetime.now().strftime("%Y-%m-%d %H:%M"))
                 )
+                # В balances идёт сумма в том виде, в каком её сохранила БД (REAL)
+                stored = cur.fetchone()["amount"]
+                if typ == "income":
+                    update_balance(cur, message.from_user.id, income=stored)
+                else:
+                    update_balance(cur, message.from_user.id, expense=stored)
             conn.commit()
+            bump_stats_version(message.from_user.id)
             emoji = "💹" if typ == "income" else "📉"
             await message.answer(
                 f"{emoji} <b>{'Доход' if typ=='income' else 'Расход'}</b> добавлен!\n"
@@ -286,9 +396,10 @@ async def add_debt(message: Message, state: FSMContext):
         try:
             with conn.cursor() as cur:
                 cur.execute(
-                    "INSERT INTO debts (user_id, debtor, amount, description, date) VALUES (%s, %s, %s, %s, %s)",
+                    "INSERT INTO debts (user_id, debtor, amount, description, date) VALUES (%s, %s, %s, %s, %s) RETURNING amount",
                     (message.from_user.id, data["debtor"], sign * amount, description, datetime.now().strftime("%Y-%m-%d %H:%M"))
                 )
+                update_balance(cur, message.from_user.id, debt=cur.fetchone()["amount"])
             conn.commit()
             await message.answer(
                 f"🤝 Долг записан: <b>{amount:.2f} сўм</b> ({description}) — {data['debtor']}",
@@ -379,10 +490,12 @@ async def process_debt_payment(callback: CallbackQuery, state: FSMContext):
         return
     try:
         with conn.cursor() as cur:
-            cur.execute("DELETE FROM debts WHERE id=%s AND user_id=%s", (debt_id, callback.from_user.id))
-            if cur.rowcount == 0:
+            cur.execute("DELETE FROM debts WHERE id=%s AND user_id=%s RETURNING amount", (debt_id, callback.from_user.id))
+            row = cur.fetchone()
+            if row is None:
                 await callback.message.answer("❌ Долг не найден.")
                 return
+            update_balance(cur, callback.from_user.id, debt=-row["amount"])
         conn.commit()
         action_text = "погашен" if action == "pay" else "возвращён"
         await callback.message.edit_text(f"✅ Долг {action_text}!", reply_markup=None)
@@ -430,12 +543,9 @@ async def show_balance(message: Message):
         return
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT COALESCE(SUM(amount), 0) AS sum FROM transactions WHERE user_id=%s AND type='income'", (uid,))
-            income = cur.fetchone()["sum"]
-            cur.execute("SELECT COALESCE(SUM(amount), 0) AS sum FROM transactions WHERE user_id=%s AND type='expense'", (uid,))
-            expense = cur.fetchone()["sum"]
-            cur.execute("SELECT COALESCE(SUM(amount), 0) AS sum FROM debts WHERE user_id=%s", (uid,))
-            debt = cur.fetchone()["sum"]
+            cur.execute("SELECT income, expense, debt FROM balances WHERE user_id=%s", (uid,))
+            row = cur.fetchone()
+        income, expense, debt = (row["income"], row["expense"], row["debt"]) if row else (0.0, 0.0, 0.0)
         balance = income - expense
         await message.answer(
             f"💼 <b>Твой баланс</b>\n\n"
@@ -452,6 +562,82 @@ async def show_balance(message: Message):
         conn.close()
 
 
+# --------------------- Диаграммы статистики ---------------------
+# Рендер идёт в отдельном процессе, чтобы не блокировать event loop.
+# Готовые картинки кешируются как Telegram file_id по ключу (user_id, period, версия данных),
+# версия увеличивается при каждом изменении транзакций пользователя.
+chart_pool = None
+chart_cache = {}
+chart_locks = {}
+stats_versions = {}
+
+
+def get_chart_pool():
+    global chart_pool
+    if chart_pool is None:
+        chart_pool = ProcessPoolExecutor(max_workers=2)
+    return chart_pool
+
+
+def bump_stats_version(user_id: int):
+    stats_versions[user_id] = stats_versions.get(user_id, 0) + 1
+    for key in [k for k in chart_cache if k[0] == user_id]:
+        del chart_cache[key]
+    for key in [k for k in chart_locks if k[0] == user_id]:
+        del chart_locks[key]
+
+
+def chart_label(name: str) -> str:
+    # Стандартный шрифт matplotlib не содержит эмодзи
+    return "".join(ch for ch in name if ord(ch) < 0x2000).strip() or name
+
+
+def render_category_chart(title: str, income_cat: list, expense_cat: list) -> bytes:
+    """Рисует круговые диаграммы по категориям. Выполняется в процессе из chart_pool."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    parts = [(name, rows) for name, rows in (("Доходы", income_cat), ("Расходы", expense_cat)) if rows]
+    fig, axes = plt.subplots(1, len(parts), figsize=(6 * len(parts), 6), squeeze=False)
+    for ax, (name, rows) in zip(axes[0], parts):
+        ax.pie(
+            [amount for _, amount in rows],
+            labels=[chart_label(category) for category, _ in rows],
+            autopct="%1.0f%%",
+            startangle=90,
+            counterclock=False,
+        )
+        ax.set_title(name)
+        ax.axis("equal")
+    fig.suptitle(f"Статистика {title}")
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=100)
+    plt.close(fig)
+    return buf.getvalue()
+
+
+def stats_period(period: str):
+    """Возвращает (SQL-фильтр, параметры фильтра, заголовок) для периода 'all' или 'YYYY-MM'."""
+    if period == "all":
+        return "", (), "за всё время"
+    year, month_num = period.split("-")
+    month_name = datetime(int(year), int(month_num), 1).strftime("%B %Y")
+    return "AND to_char(CAST(date AS timestamp), 'YYYY-MM') = %s", (period,), f"за {month_name}"
+
+
+def get_category_sums(cur, uid: int, typ: str, filter_sql: str, filter_params: tuple):
+    cur.execute(f"""
+        SELECT category, SUM(amount) AS sum
+        FROM transactions
+        WHERE user_id=%s AND type=%s {filter_sql}
+        GROUP BY category
+        ORDER BY sum DESC
+    """, (uid, typ) + filter_params)
+    return cur.fetchall()
+
+
 # --------------------- Статистика (упрощённая и исправленная) ---------------------
 @dp.message(F.text == "Статистика 📊")
 async def stats_menu(message: Message):
@@ -480,17 +666,8 @@ async def show_stats(callback: CallbackQuery):
 
     try:
         with conn.cursor() as cur:
-            if period == "all":
-                filter_sql = ""
-                params = (uid,)
-                title = "за всё время"
-            else:
-                filter_sql = "AND to_char(CAST(date AS timestamp), 'YYYY-MM') = %s"
-                params = (uid, period)
-                # Красивое название месяца
-                year, month_num = period.split("-")
-                month_name = datetime(int(year), int(month_num), 1).strftime("%B %Y")
-                title = f"за {month_name}"
+            filter_sql, filter_params, title = stats_period(period)
+            params = (uid,) + filter_params
 
             # Доходы и расходы
             cur.execute(f"""
@@ -512,25 +689,9 @@ async def show_stats(callback: CallbackQuery):
             debt_row = cur.fetchone()
             debt = debt_row['debt_sum'] if debt_row else 0.0
 
-            # Доходы по категориям
-            cur.execute(f"""
-                SELECT category, SUM(amount) AS sum
-                FROM transactions
-                WHERE user_id=%s AND type='income' {filter_sql}
-                GROUP BY category
-                ORDER BY sum DESC
-            """, params)
-            income_cat = cur.fetchall()
-
-            # Расходы по категориям
-            cur.execute(f"""
-                SELECT category, SUM(amount) AS sum
-                FROM transactions
-                WHERE user_id=%s AND type='expense' {filter_sql}
-                GROUP BY category
-                ORDER BY sum DESC
-            """, params)
-            expense_cat = cur.fetchall()
+            # Доходы и расходы по категориям
+            income_cat = get_category_sums(cur, uid, "income", filter_sql, filter_params)
+            expense_cat = get_category_sums(cur, uid, "expense", filter_sql, filter_params)
 
         bal = inc - exp
         text = f"📊 <b>Статистика {title}</b>\n\n"
@@ -550,7 +711,12 @@ async def show_stats(callback: CallbackQuery):
         if not income_cat and not expense_cat:
             text += "Нет транзакций за этот период."
 
-        await callback.message.edit_text(text)
+        markup = None
+        if CHARTS_ENABLED and (income_cat or expense_cat):
+            builder = InlineKeyboardBuilder()
+            builder.button(text="Диаграмма 📈", callback_data=f"chart_{period}")
+            markup = builder.as_markup()
+        await callback.message.edit_text(text, reply_markup=markup)
         await callback.message.answer("Главное меню:", reply_markup=main_kb())
 
     except Exception as e:
@@ -558,6 +724,57 @@ async def show_stats(callback: CallbackQuery):
         await callback.message.answer("❌ Ошибка при загрузке статистики. Попробуй позже.")
     finally:
         conn.close()
+
+
+@dp.callback_query(F.data.startswith("chart_"))
+async def show_stats_chart(callback: CallbackQuery):
+    await callback.answer()
+    period = callback.data[6:]  # "all" или "2026-01"
+    uid = callback.from_user.id
+    key = (uid, period, stats_versions.get(uid, 0))
+
+    lock = chart_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        # Тот же график уже загружен в Telegram — отправляем по file_id
+        file_id = chart_cache.get(key)
+        if file_id:
+            await callback.message.answer_photo(file_id)
+            return
+
+        conn = get_db_connection()
+        if not conn:
+            await callback.message.answer("❌ Ошибка базы данных. Попробуй позже.")
+            return
+        try:
+            filter_sql, filter_params, title = stats_period(period)
+            with conn.cursor() as cur:
+                income_cat = get_category_sums(cur, uid, "income", filter_sql, filter_params)
+                expense_cat = get_category_sums(cur, uid, "expense", filter_sql, filter_params)
+        except Exception as e:
+            logging.error(f"Chart data error: {e}", exc_info=True)
+            await callback.message.answer("❌ Ошибка при загрузке статистики. Попробуй позже.")
+            return
+        finally:
+            conn.close()
+
+        if not income_cat and not expense_cat:
+            await callback.message.answer("Нет транзакций за этот период.")
+            return
+
+        try:
+            png = await asyncio.get_running_loop().run_in_executor(
+                get_chart_pool(),
+                render_category_chart,
+                title,
+                [(c["category"], c["sum"]) for c in income_cat],
+                [(c["category"], c["sum"]) for c in expense_cat],
+            )
+            sent = await callback.message.answer_photo(BufferedInputFile(png, filename=f"stats_{period}.png"))
+            if key[2] == stats_versions.get(uid, 0):
+                chart_cache[key] = sent.photo[-1].file_id
+        except Exception as e:
+            logging.error(f"Chart render error: {e}", exc_info=True)
+            await callback.message.answer("❌ Не удалось построить диаграмму.")
 # --------------------- Категории ---------------------
 @dp.message(F.text == "Категории ➕")
 async def add_category_start(message: Message, state: FSMContext):
@@ -626,7 +843,9 @@ async def clear_data_confirm(callback: CallbackQuery, state: FSMContext):
             cur.execute("DELETE FROM transactions WHERE user_id=%s", (uid,))
             cur.execute("DELETE FROM debts WHERE user_id=%s", (uid,))
             cur.execute("DELETE FROM categories WHERE user_id=%s", (uid,))
+            cur.execute("DELETE FROM balances WHERE user_id=%s", (uid,))
         conn.commit()
+        bump_stats_version(uid)
         await callback.message.edit_text("🗑️ Все данные аннулированы!", reply_markup=None)
         await callback.message.answer("Выбери действие:", reply_markup=main_kb())
     except Exception as e:
@@ -652,15 +871,19 @@ async def unknown_message(message: Message):
 # ------------------- Инициализация БД при старте -------------------
 async def on_startup():
     init_db()
+    check_balances()
     logging.info("Бот запущен (polling mode)")
 
 # ------------------- Главный запуск (polling!) -------------------
 async def main():
     await on_startup()
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    try:
+        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        if chart_pool is not None:
+            chart_pool.shutdown()
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())
 
     app = web.Application()